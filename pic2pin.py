@@ -1,44 +1,62 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import sys
 import argparse
 import hashlib
-import imghdr
+import mmap
+from collections import Counter, defaultdict
+from dataclasses import asdict, dataclass
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
 import exifread
-from geopy.geocoders import Nominatim
-from tqdm import tqdm
 
 import json
-import simplekml
+from xml.sax.saxutils import escape
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+
+JPEG_MAGIC = b'\xff\xd8\xff'
+KML_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+    '<Document>\n'
+    '<open>1</open>\n'
+)
+KML_FOOTER = '</Document>\n</kml>\n'
+# Decimal places of latitude/longitude that identify a location for address lookups (~110m)
+ADDRESS_PRECISION = 3
+# Below this many files, scan with threads: hashlib releases the GIL while hashing, and starting
+# worker processes would cost more than the EXIF parsing they parallelise
+THREAD_POOL_LIMIT = 100
+# Bytes hashed to tell files apart in --quick mode
+PREFIX_SIZE = 4096
+# Bytes read to find the EXIF APP1 segment (at most 64 KiB long), which usually comes first or right
+# after a short APP0 (JFIF); files whose segment ends past this window are parsed in full
+EXIF_WINDOW = 1 << 16
+
+
+@dataclass(slots=True)
+class FileReport:
+    digest: str
+    paths: list
+    latitude: float | None = None
+    longitude: float | None = None
+    altitude: float | None = None
+    address: str = ""
+    algorithm: str = 'md5'
 
-
-SUPPORTED = ['jpeg']
-
-
-class FileReport(object):
-    def __init__(self, digest, paths, geoloc=None):
-        self.digest = digest
-        self.paths = paths
-
-        gps=grab_gps(paths[0])
-        self.latitude=gps.get('latitude', None)
-        self.longitude=gps.get('longitude', None)
-        self.altitude=gps.get('altitude', None)
-        self.address = ""
-
-        if geoloc is not None and self.latitude is not None:
-            try:
-                self.address = geoloc.reverse(f"{self.latitude}, {self.longitude}").address
-            except TypeError:
-                pass
-    
-    
     def __str__(self):
         files = "\t" + "\n\t".join(self.paths)
         coords = "{}, {}".format(self.latitude, self.longitude)
         addr = '\nADDRESS:\n\t' + self.address + '\n' if self.address else ''
-        output = "\nFILE: (md5) {d}\n{f}\nCOORDINATES (lat, long):\n\t{ll}{a}\n".format(
+        output = "\nFILE: ({h}) {d}\n{f}\nCOORDINATES (lat, long):\n\t{ll}{a}\n".format(
+            h=self.algorithm,
             d=self.digest,
             f=files,
             ll=coords,
@@ -47,6 +65,15 @@ class FileReport(object):
 
 
 
+def positive_int(value):
+    ''' argparse type for integers of at least 1
+    '''
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {value}")
+    return number
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser()
     supported_formats = ['plain', 'json', 'kml']
@@ -75,71 +102,204 @@ def parse_arguments():
     parser.add_argument("-v", "--verbose", 
                     help="Prints progress bars (quiet by default)",
                     action="store_true")
+    parser.add_argument("-H", "--hash",
+                    default='md5',
+                    choices=sorted(HASHES),
+                    help="Hash used to identify duplicate files (default: md5)")
+    parser.add_argument("-q", "--quick",
+                    help="Only hash files in full when their size and first 4 KiB match another file",
+                    action="store_true")
+    parser.add_argument("-j", "--jobs",
+                    help="Number of parallel scanning jobs (default: CPU count)",
+                    type=positive_int)
 
     return vars(parser.parse_args())
 
 
-def md5(fname):
-    '''Take a path to a file and return the MD5 hash of the file as a hex string
+def progress(iterable, verbose, total=None):
+    '''Wrap iterable in a tqdm progress bar if verbose, only importing tqdm when it is needed
+    '''
+    if not verbose:
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable, total=total)
+
+
+def readahead(f):
+    '''Hint the kernel to prefetch the whole of the open file f, where supported
+    '''
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+
+
+def md5(data):
+    '''Take a bytes-like object and return its MD5 hash as a hex string
+    '''
+    return hashlib.md5(data).hexdigest()
+
+
+def blake3sum(data):
+    '''Take a bytes-like object and return the first 16 bytes of its BLAKE3 hash as a hex string
+    '''
+    return blake3.blake3(data).hexdigest(length=16)
+
+
+HASHES = {'md5': md5}
+if blake3 is not None:
+    HASHES['blake3'] = blake3sum
+
+
+def scan_file(path, algorithm='md5'):
+    '''Take a path to a file and return a tuple of its hash and GPS data, reading the file only once
+    '''
+    with open(path, "rb") as f:
+        readahead(f)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return HASHES[algorithm](mm), read_gps(mm)
+
+
+def quick_scan_file(path, algorithm='md5'):
+    '''Take a path to a file and return a tuple of its size, the hash of its first PREFIX_SIZE bytes and its GPS data
     '''
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        prefix = f.read(PREFIX_SIZE)
+        f.seek(0)
+        return size, HASHES[algorithm](prefix), read_gps(f)
+
+
+def hash_file(path, algorithm='md5'):
+    '''Take a path to a file and return its hash as a hex string
+    '''
+    with open(path, "rb") as f:
+        readahead(f)
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return HASHES[algorithm](mm)
 
 
 def is_valid_file(file):
     ''' Takes a path to a file and returns whether it is supported by pic2pin
     '''
-    return imghdr.what(file) in SUPPORTED
+    with open(file, "rb") as f:
+        return f.read(len(JPEG_MAGIC)) == JPEG_MAGIC
 
 
-def initialize_files(paths, recursive=False):
-    '''Initialize and return the file dictionary in the format {md5(file):[paths]}
+def iter_files(root, recursive=False):
+    '''Yield the path of every regular file in the directory root, without following directory symlinks
+    '''
+    subdirs = []
+    try:
+        entries = os.scandir(root)
+    except OSError:
+        # Skip unreadable directories, as os.walk does
+        return
+    with entries:
+        for entry in entries:
+            if entry.is_file():
+                yield entry.path
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+    for subdir in subdirs:
+        yield from iter_files(subdir, recursive=recursive)
+
+
+def collect_files(paths, recursive=False):
+    '''Return the list of supported files found in paths
 
     Arguments:
-        path: the FILE or DIRECTORY to initialize
+        paths: the FILES or DIRECTORY to search
 
     Keyword arguments:
         recursive: recurse into subdirectories (default is False)
     '''
-    hashdict = {}
     if os.path.isdir(paths[0]) and len(paths) == 1:
-        for root, _, files in os.walk(paths[0]):
-            for f in files:
-                full_path = os.path.join(root, f)
-                if is_valid_file(full_path):
-                    digest = md5(full_path)
-                    if hashdict.get(digest):
-                        hashdict[digest].append(full_path)
-                    else:
-                        hashdict[digest] = [full_path]
-            if not recursive:
-                break
-    else:
-        for path in paths:
-            if is_valid_file(path):
-                digest = md5(path)
-                if hashdict.get(digest):
-                    hashdict[digest].append(path)
-                else:
-                    hashdict[digest] = [path]
-    return hashdict
+        paths = iter_files(paths[0], recursive=recursive)
+    return [path for path in paths if is_valid_file(path)]
+
+
+def fingerprint_files(executor, files, algorithm, verbose):
+    '''Return an iterator of (hash, GPS data) tuples for files, hashing every file in full
+    '''
+    results = executor.map(partial(scan_file, algorithm=algorithm), files, chunksize=8)
+    return progress(results, verbose, total=len(files))
+
+
+def quick_fingerprint_files(executor, files, algorithm, verbose):
+    '''Yield (hash, GPS data) tuples for files, hashing only the files whose size and prefix collide in full
+
+    Files with a unique size and prefix are identified by "prefix:" and the hash of their first PREFIX_SIZE bytes.
+    '''
+    results = executor.map(partial(quick_scan_file, algorithm=algorithm), files, chunksize=8)
+    results = list(progress(results, verbose, total=len(files)))
+    counts = Counter((size, prefix) for size, prefix, _ in results)
+    colliding = [path for path, (size, prefix, _) in zip(files, results) if counts[size, prefix] > 1]
+    full = dict(zip(colliding, executor.map(partial(hash_file, algorithm=algorithm), colliding, chunksize=8)))
+    for path, (size, prefix, gps) in zip(files, results):
+        yield full.get(path, "prefix:" + prefix), gps
+
+
+def initialize_files(paths, recursive=False, algorithm='md5', quick=False, jobs=None, verbose=False):
+    '''Initialize and return the report dictionary in the format {hash(file):FileReport}
+
+    Arguments:
+        path: the FILE or DIRECTORY to initialize
+
+    Keyword arguments:
+        recursive: recurse into subdirectories (default is False)
+        algorithm: name of the hash in HASHES used to fingerprint files (default is md5)
+        quick: only hash files in full when their size and first bytes match another file (default is False)
+        jobs: number of workers used for scanning (default is CPU count); these are threads
+              for fewer than THREAD_POOL_LIMIT files and processes otherwise
+        verbose: show a progress bar while scanning (default is False)
+    '''
+    files = collect_files(paths, recursive=recursive)
+    hashdict = defaultdict(list)
+    gpsdict = {}
+    fingerprint = quick_fingerprint_files if quick else fingerprint_files
+    pool = ThreadPoolExecutor if len(files) < THREAD_POOL_LIMIT else ProcessPoolExecutor
+    with pool(max_workers=jobs or os.cpu_count()) as executor:
+        for (digest, gps), path in zip(fingerprint(executor, files, algorithm, verbose), files):
+            hashdict[digest].append(path)
+            gpsdict.setdefault(digest, gps)
+    return {digest: FileReport(digest, paths, algorithm=algorithm, **gpsdict[digest])
+            for digest, paths in hashdict.items()}
 
     
 
+def dms_to_decimal(dn, dd, mn, md, sn, sd):
+    '''Takes the numerators and denominators of degrees, minutes and seconds and returns decimal degrees
+    '''
+    return dn / dd + mn / md / 60 + sn / sd / 3600
+
+
 def ifdtag_to_decimal(tag):
     '''Takes an exifread.classes.IfdTag, and converts the degrees-minutes-seconds GPS data to decimal
     '''
-    degree = tag.values[0].num / tag.values[0].den
-    minute = tag.values[1].num / tag.values[1].den / 60
-    second = tag.values[2].num / tag.values[2].den / 3600
-    return degree + minute + second
+    degree, minute, second = tag.values[:3]
+    return dms_to_decimal(degree.num, degree.den, minute.num, minute.den, second.num, second.den)
 
 
-def grab_gps(file_path):
-    '''Take a file path and return a dictionary of the GPS data as integers in a format as below:
+def find_exif_end(data):
+    '''Take the leading bytes of a JPEG and return the offset just past its EXIF APP1 segment
+
+    Returns None if no EXIF segment starts within data.
+    '''
+    offset = 2
+    while offset + 4 <= len(data) and data[offset] == 0xFF:
+        marker = data[offset + 1]
+        if marker in (0xD9, 0xDA):
+            # EOI or start of scan: no metadata segments follow
+            return None
+        length = int.from_bytes(data[offset + 2:offset + 4], "big")
+        if marker == 0xE1 and data[offset + 4:offset + 10] == b"Exif\0\0":
+            return offset + 2 + length
+        offset += 2 + length
+    return None
+
+
+def read_gps(fd):
+    '''Take a binary file object and return a dictionary of the GPS data as integers in a format as below:
     {
         'latitude' : I,
         'longitude': J,
@@ -147,35 +307,58 @@ def grab_gps(file_path):
     }
 
     Arguments:
-        file_path --- the file to process
+        fd --- the file object to process
 
     Return:
         meta --- GPS data stripped from file and converted to decimal
     '''
-    with open(file_path, "rb") as fd:
-        header = exifread.process_file(fd, details=False)
+    window = fd.read(EXIF_WINDOW)
+    exif_end = find_exif_end(window)
+    header = None
+    # Only trust the window when it holds the whole EXIF segment, otherwise tags past the cut read as zeros
+    if exif_end is not None and exif_end <= len(window):
+        try:
+            header = exifread.process_file(io.BytesIO(window), details=False, stop_tag="GPSAltitude")
+        except Exception:
+            pass
+    if header is None:
+        try:
+            header = exifread.process_file(fd, details=False, stop_tag="GPSAltitude")
+        except Exception:
+            # A truncated or corrupt image has no usable GPS data, but must not abort the scan
+            header = {}
 
     meta = {}
     lat_dms = header.get("GPS GPSLatitude")
     long_dms = header.get("GPS GPSLongitude")
     alt_tag = header.get("GPS GPSAltitude")
 
+    # Corrupt or truncated GPS tags (zero denominators, missing refs) count as no GPS data
     if lat_dms and long_dms:
-        latitude = ifdtag_to_decimal(lat_dms)
-        longitude = ifdtag_to_decimal(long_dms)
-        if header['GPS GPSLatitudeRef'].printable  == 'S': 
-            latitude  *= -1
-        if header['GPS GPSLongitudeRef'].printable == 'W': 
-            longitude *= -1
-        meta["longitude"] = longitude
-        meta["latitude"] = latitude
+        try:
+            latitude = ifdtag_to_decimal(lat_dms)
+            longitude = ifdtag_to_decimal(long_dms)
+            if header['GPS GPSLatitudeRef'].values  == 'S': 
+                latitude  *= -1
+            if header['GPS GPSLongitudeRef'].values == 'W': 
+                longitude *= -1
+        except (ZeroDivisionError, IndexError, KeyError):
+            pass
+        else:
+            meta["longitude"] = longitude
+            meta["latitude"] = latitude
 
     if alt_tag:
-        alt_ratio = alt_tag.values[0]
-        altitude = alt_ratio.num / alt_ratio.den
-        if header['GPS GPSAltitudeRef'] == 1: 
-            altitude *= -1
-        meta["altitude"] = altitude
+        try:
+            alt_ratio = alt_tag.values[0]
+            altitude = alt_ratio.num / alt_ratio.den
+        except (ZeroDivisionError, IndexError):
+            pass
+        else:
+            alt_ref = header.get('GPS GPSAltitudeRef')
+            if alt_ref and alt_ref.values[0] == 1: 
+                altitude *= -1
+            meta["altitude"] = altitude
 
     return meta
 
@@ -186,58 +369,94 @@ def lookup_address(geoloc, lat, long):
     try:
         location = geoloc.reverse("{}, {}".format(lat, long))
         return location.address
-    except TypeError:
-        return "ADDRESS NOT FOUND"
+    except (TypeError, AttributeError):
+        return ""
+
+
+def lookup_addresses(reports, geoloc):
+    ''' Takes an iterable of FileReports and a geopy geolocator and fills in the address of each located report
 
+    Reports within roughly 100m of each other (same coordinates to ADDRESS_PRECISION decimal places) share
+    a single lookup, and lookups are made no faster than Nominatim's limit of one request per second.
+    '''
+    from geopy.extra.rate_limiter import RateLimiter
+
+    lookup = RateLimiter(partial(lookup_address, geoloc), min_delay_seconds=1, return_value_on_exception="")
+    cache = {}
+    for report in reports:
+        if report.latitude is None:
+            continue
+        key = (round(report.latitude, ADDRESS_PRECISION), round(report.longitude, ADDRESS_PRECISION))
+        if key not in cache:
+            cache[key] = lookup(report.latitude, report.longitude)
+        report.address = cache[key]
 
-def format_plain(reports):
-    return "".join([r.__str__() for r in reports]) + "\n"
+
+def write_plain(reports, fp):
+    for report in reports:
+        fp.write(report.__str__())
+    fp.write("\n")
 
 
-def format_json(reports):
-    tmp = {i: vars(report) for i, report in enumerate(reports)}
-    return json.dumps(tmp)
+def write_json(reports, fp):
+    tmp = {i: asdict(report) for i, report in enumerate(reports)}
+    for chunk in json.JSONEncoder().iterencode(tmp):
+        fp.write(chunk)
+    fp.write("\n")
 
 
-def format_kml(reports):
-    kml = simplekml.Kml(open=1)
+def kml_placemark(report):
+    point = ''
+    if report.latitude is not None:
+        point = f"<Point><coordinates>{report.longitude},{report.latitude}</coordinates></Point>"
+    return "<Placemark><name>{n}</name><description>{d}</description>{p}</Placemark>".format(
+        n=escape(report.digest),
+        d=escape(", ".join([os.path.basename(p) for p in report.paths])),
+        p=point)
+
+
+def write_kml(reports, fp):
+    fp.write(KML_HEADER)
     for report in reports:
-        pnt = kml.newpoint()
-        pnt.name = report.digest
-        pnt.description = ", ".join([os.path.basename(p) for p in report.paths])
-        pnt.coords = [(report.longitude, report.latitude)]
-    return kml.kml()
+        fp.write(kml_placemark(report) + "\n")
+    fp.write(KML_FOOTER)
 
  
-def main(path, format, address, ignore, recursive, output, verbose):
+def main(path, format, address, ignore, recursive, output, verbose, hash, quick, jobs):
     '''TODO:
         - implement output
         - 
     '''
     reports = []
-    geolocator = Nominatim(user_agent="pic2pin") if address else None
-    init = initialize_files(path, recursive=recursive)
-
-    for digest, paths in (tqdm(init.items()) if verbose else init.items()):
-        file_report = FileReport(digest, paths, geoloc=geolocator)
+    geolocator = None
+    if address:
+        from geopy.geocoders import Nominatim
+        geolocator = Nominatim(user_agent="pic2pin")
+    init = initialize_files(path, recursive=recursive, algorithm=hash, quick=quick,
+                            jobs=jobs, verbose=verbose)
+
+    for file_report in init.values():
         if ignore and not file_report.latitude and not file_report.longitude and not file_report.altitude:
             pass
         else:
             reports.append(file_report)
+
+    if geolocator is not None:
+        lookup_addresses(progress(reports, verbose), geolocator)
  
     # Switch for formatting
-    out_str = {
-        'plain' : format_plain,
-        'json' : format_json,
-        'kml' : format_kml
-        #'pdf' : format_pdf
-    }[format[0]](reports)
+    writer = {
+        'plain' : write_plain,
+        'json' : write_json,
+        'kml' : write_kml
+        #'pdf' : write_pdf
+    }[format[0]]
 
     if output:
         with open(output, "w") as wp:
-            wp.write(out_str)
+            writer(reports, wp)
     else:
-        print(out_str)
+        writer(reports, sys.stdout)
 
 
 if __name__=='__main__':